@@ -1,12 +1,54 @@
 import logging
-from copy import deepcopy
-from typing import Optional, List, Dict, Any
+from functools import lru_cache
+from typing import Optional, List, AsyncGenerator, Union, Dict
 
+import tiktoken
 from openai import OpenAI, AsyncOpenAI
 
 # from manager.config_manager import ConfigManager
 from models.agent_config import ChatGPTAgentConfig, Message
-from utils import getenv
+from utils import getenv, openai_get_tokens
+import openai_scheduler
+
+# shared by every agent so all chats reuse one connection pool, retries are
+# handled by openai_scheduler. Created on first use so a missing key is
+# reported by main.check_system_envs instead of failing at import.
+@lru_cache(maxsize=None)
+def get_shared_async_client() -> AsyncOpenAI:
+    return AsyncOpenAI(api_key=getenv("OPENAI_API_KEY"), max_retries=0, timeout=30.0)
+
+
+# approximate per message overhead of the chat format
+TOKENS_PER_MESSAGE = 4
+SUMMARY_MAX_TOKENS = 500
+SUMMARY_PREFIX = "Prior conversation summary: "
+SUMMARY_PROMPT = (
+    "Summarize the following conversation between a user and an assistant. "
+    "Keep every fact, name, preference and open question needed to continue the conversation."
+)
+
+
+# tiktoken downloads BPE files on first use, so encodings are only loaded
+# by load_encodings (run off the event loop on startup) and token counts
+# fall back to a character estimate for anything that is not loaded
+PRELOADED_ENCODINGS = ("o200k_base", "cl100k_base")
+_encodings: Dict[str, tiktoken.Encoding] = {}
+
+
+def load_encodings():
+    for name in PRELOADED_ENCODINGS:
+        try:
+            _encodings[name] = tiktoken.get_encoding(name)
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"Could not load tiktoken encoding {name}: {e}")
+
+
+def get_encoding(model_name: str) -> Optional[tiktoken.Encoding]:
+    try:
+        name = tiktoken.encoding_name_for_model(model_name)
+    except KeyError:
+        name = "o200k_base"
+    return _encodings.get(name)
 
 
 class ChatGptAgent:
@@ -14,64 +56,106 @@ class ChatGptAgent:
         self,
         agent_config: ChatGPTAgentConfig,
         logger: Optional[logging.Logger] = None,
-        messages: Optional[List[Message]] = None,
+        messages: Optional[List[Union[Message, dict]]] = None,
         # config_manager: ConfigManager = None
     ):
         self.async_openai_client: AsyncOpenAI
         self.openai_client: OpenAI
         self.agent_config = agent_config
-        self.messages = messages or []
+        # stored history is replayed from raw dicts without validation
+        self.messages = [
+            Message.model_construct(**message) if isinstance(message, dict) else message
+            for message in messages or []
+        ]
         self.logger = logger or logging.getLogger(__name__)
-        self.openai_api_key = getenv("OPENAI_API_KEY")
         super().__init__()
 
-        self.async_openai_client = AsyncOpenAI(
-            api_key=self.openai_api_key
+        self.async_openai_client = get_shared_async_client()
+
+        # built once per agent and never touched again, it is the head of
+        # the byte stable prefix sent to OpenAI on every turn
+        self._system_prefix: List[dict] = (
+            [{"role": "system", "content": agent_config.prompt_preamble}] if agent_config.prompt_preamble else []
         )
+        self._formatted: List[dict] = list(self._system_prefix)
+        self._last_role: Optional[str] = None
+        self._has_summary = False
+        self._encoding = get_encoding(agent_config.model_name)
+        self._token_count = sum(self._count_tokens(message["content"]) + TOKENS_PER_MESSAGE for message in self._formatted)
+        for message in self.messages:
+            self._append_message(message)
 
     def format_openai_chat_messages_from_transcript(self) -> List[dict]:
-        chat_messages: List[Dict[str, Optional[Any]]] = (
-                ([{"role": "system", "content": self.agent_config.prompt_preamble}] if self.agent_config.prompt_preamble else [])
-        )
+        return self._formatted
+
+    def _count_tokens(self, text: str) -> int:
+        if self._encoding is None:
+            return len(text) // openai_scheduler.CHARS_PER_TOKEN
+        return len(self._encoding.encode(text))
 
-        # merge consecutive bot messages
-        new_event_logs = []
-        idx = 0
-        while idx < len(self.messages):
-            bot_messages_buffer: List[Message] = []
-            current_log = self.messages[idx]
-            while isinstance(current_log, Message) and current_log.sender == "bot":
-                bot_messages_buffer.append(current_log)
-                idx += 1
-                try:
-                    current_log = self.messages[idx]
-                except IndexError:
-                    break
-            if bot_messages_buffer:
-                merged_bot_message = deepcopy(bot_messages_buffer[-1])
-                merged_bot_message.text = " ".join(
-                    event_log.text for event_log in bot_messages_buffer
-                )
-                new_event_logs.append(merged_bot_message)
+    def _append_message(self, message: Message):
+        # consecutive bot messages are merged into the last assistant turn,
+        # earlier dicts are never rebuilt which keeps formatting O(1) per
+        # message and the prompt prefix byte stable for OpenAI prompt caching
+        self._token_count += self._count_tokens(message.text)
+        if message.sender == "bot":
+            if self._last_role == "assistant":
+                self._formatted[-1]["content"] += " " + message.text
             else:
-                new_event_logs.append(current_log)
-                idx += 1
+                self._formatted.append({"role": "assistant", "content": message.text})
+                self._token_count += TOKENS_PER_MESSAGE
+                self._last_role = "assistant"
+        else:
+            self._formatted.append({"role": "user", "content": message.text})
+            self._token_count += TOKENS_PER_MESSAGE
+            self._last_role = "user"
+
+    async def _compact_history(self):
+        if self._token_count <= self.agent_config.max_tokens_context:
+            return
+        head = len(self._system_prefix)
+        start = head + 1 if self._has_summary else head
+        history = self._formatted[start:]
+        # the most recent half of the conversation is kept verbatim
+        keep = max(1, len(history) // 2)
+        compacted = history[:-keep]
+        if not compacted:
+            return
+
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in compacted)
+        if self._has_summary:
+            transcript = self._formatted[head]["content"] + "\n" + transcript
+        chat_completion = await openai_scheduler.submit(
+            self.async_openai_client,
+            {
+                "messages": [
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": transcript},
+                ],
+                "max_tokens": SUMMARY_MAX_TOKENS,
+                "temperature": 0,
+                "model": self.agent_config.model_name,
+            },
+        )
+        summary_text = chat_completion.choices[0].message.content
+        if not summary_text:
+            # refusals and empty completions leave the history as it is
+            self.logger.warning("History summary came back empty, skipping compaction")
+            return
+        summary = {"role": "system", "content": SUMMARY_PREFIX + summary_text}
 
-        for event_log in new_event_logs:
-            if isinstance(event_log, Message):
-                chat_messages.append(
-                    {
-                        "role": "assistant" if event_log.sender == "bot" else "user",
-                        "content": event_log.text,
-                    }
-                )
-        return chat_messages
+        # the compacted list becomes the new stable prefix for later turns
+        self._formatted[head:] = [summary] + history[-keep:]
+        self._has_summary = True
+        self._token_count = sum(self._count_tokens(message["content"]) + TOKENS_PER_MESSAGE for message in self._formatted)
 
+    def record_message(self, message: Message):
+        self.messages.append(message)
+        self._append_message(message)
 
     def get_chat_parameters(self):
-        messages = self.format_openai_chat_messages_from_transcript()
         parameters = {
-            "messages": messages,
+            "messages": self._formatted,
             "max_tokens": self.agent_config.max_tokens,
             "temperature": self.agent_config.temperature,
             "model": self.agent_config.model_name
@@ -82,15 +166,29 @@ class ChatGptAgent:
         self,
         message: Message
     ):
-        self.messages.append(message)
-        if message.sender == "bot":
-            return None
+        self.record_message(message)
+        await self._compact_history()
         chat_parameters = self.get_chat_parameters()
-        if chat_parameters.get("engine") and not chat_parameters.get("model"):
-            chat_parameters["model"] = chat_parameters["engine"]
-            del chat_parameters["engine"]
-        chat_completion = await self.async_openai_client.chat.completions.create(**chat_parameters)
+        chat_completion = await openai_scheduler.submit(self.async_openai_client, chat_parameters)
         text = chat_completion.choices[0].message.content
-        agent_message = Message(sender="bot", text=text)
-        self.messages.append(agent_message)
-        return text
\ No newline at end of file
+        self.record_message(Message.model_construct(sender="bot", text=text))
+        return text
+
+    async def stream_response(
+        self,
+        message: Message
+    ) -> AsyncGenerator[str, None]:
+        self.record_message(message)
+        await self._compact_history()
+        chat_parameters = self.get_chat_parameters()
+        tokens = []
+        try:
+            async with openai_scheduler.open_stream(self.async_openai_client, chat_parameters) as stream:
+                async for token in openai_get_tokens(stream, self.logger):
+                    if isinstance(token, str):
+                        tokens.append(token)
+                        yield token
+        finally:
+            # record whatever was generated, even if the consumer stopped early
+            if tokens:
+                self.record_message(Message.model_construct(sender="bot", text="".join(tokens)))
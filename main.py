@@ -1,26 +1,27 @@
+import asyncio
 import logging
 import os
+import time
 from datetime import datetime, UTC, timedelta
-from typing import Dict
+from functools import lru_cache
+from typing import Dict, AsyncGenerator, List, Tuple, Optional
 
-import backoff
 import jwt
+import orjson
 from dotenv import load_dotenv
 from fastapi import FastAPI, APIRouter, HTTPException, Depends
-from fastapi.openapi.docs import get_swagger_ui_html
-from fastapi.openapi.models import OpenAPI
+from fastapi.openapi.docs import get_swagger_ui_html, get_redoc_html
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.security import HTTPBearer
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo.errors import ServerSelectionTimeoutError, ConnectionFailure
+from pymongo.errors import ConnectionFailure
 from pymongo.synchronous.collection import Collection
 from starlette.middleware.cors import CORSMiddleware
 from starlette.requests import Request
-from starlette.responses import JSONResponse
-from starlette.websockets import WebSocket, WebSocketDisconnect
+from starlette.websockets import WebSocket, WebSocketDisconnect, WebSocketState
 
-from agents.chat_gpt_agent import ChatGptAgent
-from models.agent_config import Message, ClientAgentConfig, FetchClientAgentConfig, \
-    ConversationHistory, User
+from agents.chat_gpt_agent import ChatGptAgent, load_encodings
+from models.agent_config import Message, ClientAgentConfig, FetchClientAgentConfig, User
 from utils import getenv
 
 load_dotenv()
@@ -29,6 +30,28 @@ mongo_client: Collection = None
 mongo_db: Collection = None
 config_collection: Collection = None
 conversation_collection: Collection = None
+archive_collection: Collection = None
+# updated by the keepalive task so requests never wait on a ping
+_mongo_ok: bool = True
+MONGO_KEEPALIVE_INTERVAL = int(getenv("MONGO_KEEPALIVE_INTERVAL", 30))
+# how often the keepalive task re-pings while mongo is marked unhealthy
+MONGO_RECHECK_INTERVAL = 1
+_mongo_recheck = asyncio.Event()
+_mongo_keepalive_task: Optional[asyncio.Task] = None
+
+# stored conversations keep only the latest messages, older ones are archived
+MAX_STORED_MESSAGES = int(getenv("MAX_STORED_MESSAGES", 500))
+
+# streamed replies are coalesced into frames of up to this many seconds or characters
+STREAM_FLUSH_INTERVAL = 0.02
+STREAM_FLUSH_CHARS = 64
+STREAM_QUEUE_SIZE = 64
+
+# client agent configs rarely change, keep them in memory for a while
+CONFIG_CACHE_TTL = int(getenv("CONFIG_CACHE_TTL", 300))
+CONFIG_CACHE_MAX_SIZE = int(getenv("CONFIG_CACHE_MAX_SIZE", 1024))
+_config_cache: Dict[Tuple[str, str], Tuple[float, ClientAgentConfig]] = {}
+_config_inflight: Dict[Tuple[str, str], asyncio.Task] = {}
 
 API_BASE_PATH = os.getenv("API_BASE_PATH", '')
 # fast api app creation
@@ -51,11 +74,14 @@ check_system_envs()
 
 app = FastAPI(
     title="ChatBot",
+    default_response_class=ORJSONResponse,
     summary="ChatBot!",
     version='v0.0.1',
-    redoc_url=f"{API_BASE_PATH}/redoc",
-    docs_url=f"{API_BASE_PATH}/docs",
-    openapi_url=f"{API_BASE_PATH}/openapi.json",
+    # the schema and docs are served by chat_router, FastAPI's built-in
+    # routes would shadow them and re-serialize the schema on every request
+    redoc_url=None,
+    docs_url=None,
+    openapi_url=None,
     swagger_ui_parameters={
         "displayRequestDuration": True,
         "displayOperationId": True,
@@ -80,6 +106,10 @@ logger.setLevel(logging.DEBUG)
 
 oauth2_scheme = HTTPBearer()
 
+# resolved once, these are read on every authenticated request
+_JWT_SECRET = getenv("JWT_SECRET_KEY")
+_JWT_ALGS = [getenv("JWT_ALGORITHM", "HS256")]
+
 def create_jwt_token(data: dict, expires_delta: timedelta = None):
     # things to encode
     to_encode = data.copy()
@@ -89,28 +119,34 @@ def create_jwt_token(data: dict, expires_delta: timedelta = None):
     to_encode.update({"exp": expire})
     # encode JWT
     encoded_jwt = jwt.encode(
-        to_encode, getenv("JWT_SECRET_KEY"), algorithm=getenv("JWT_ALGORITHM", "HS256")
+        to_encode, _JWT_SECRET, algorithm=_JWT_ALGS[0]
     )
     # return encoded JWT
     return encoded_jwt
 
 
+# Verified tokens are cached, failures raise and are never cached
+@lru_cache(maxsize=4096)
+def _verify(token_credentials: str) -> Tuple[str, Optional[float]]:
+    # decode JWT payload
+    payload = jwt.decode(token_credentials, _JWT_SECRET, algorithms=_JWT_ALGS)
+    # get username from payload
+    username: str = payload.get("sub")
+    # if no username invalidate
+    if username is None:
+        raise HTTPException(status_code=400, detail="Token Invalid")
+    return username, payload.get("exp")
+
+
 # Function to decode and verify the JWT token
 def get_current_user(token: str = Depends(oauth2_scheme)):
     try:
         # get token credentials
         token_credentials = token.credentials
-        # decode JWT payload
-        payload = jwt.decode(
-            token_credentials,
-            getenv("JWT_SECRET_KEY"),
-            algorithms=[getenv("JWT_ALGORITHM", "HS256")],
-        )
-        # get username from payload
-        username: str = payload.get("sub")
-        # if no username invalidate
-        if username is None:
-            raise HTTPException(status_code=400, detail="Token Invalid")
+        username, expire = _verify(token_credentials)
+        # a cached token still has to be checked for expiry
+        if expire is not None and expire <= time.time():
+            raise jwt.exceptions.ExpiredSignatureError("Signature has expired")
         return username
     except jwt.exceptions.ExpiredSignatureError:
         raise HTTPException(
@@ -125,25 +161,134 @@ async def is_mongo_alive(mongo_client):
     try:
         await mongo_client.admin.command("ping")
         return True
-    except ServerSelectionTimeoutError:
+    except ConnectionFailure:
         return False
 
 
-@backoff.on_exception(backoff.expo, ConnectionFailure, max_tries=3, jitter=None)
-async def update_mongo_db():
+def connect_mongo_db():
     global mongo_client
     global mongo_db
     global config_collection
     global conversation_collection
+    global archive_collection
+
+    # motor monitors the pool and reconnects on its own, so the client is
+    # created once per process instead of being pinged on every request
+    mongo_client = AsyncIOMotorClient(
+        getenv("MONGODB_URI"),
+        maxPoolSize=int(getenv("MONGODB_MAX_POOL_SIZE", 50)),
+        minPoolSize=int(getenv("MONGODB_MIN_POOL_SIZE", 5)),
+        serverSelectionTimeoutMS=5000,
+    )
+    mongo_db = mongo_client[getenv("MONGODB_DATABASE")]
+    config_collection = mongo_db[getenv("CONFIG_COLLECTION")]
+    conversation_collection = mongo_db[getenv("CONVERSATION_COLLECTION")]
+    archive_collection = mongo_db[getenv("ARCHIVE_COLLECTION", f"{getenv('CONVERSATION_COLLECTION')}_archive")]
+
 
-    if mongo_client is None or not await is_mongo_alive(mongo_client):
+async def _mongo_keepalive():
+    global _mongo_ok
+
+    while True:
+        interval = MONGO_KEEPALIVE_INTERVAL if _mongo_ok else MONGO_RECHECK_INTERVAL
+        try:
+            # woken early by mark_mongo_unhealthy
+            await asyncio.wait_for(_mongo_recheck.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        _mongo_recheck.clear()
+        # motor reconnects on its own, the task only tracks health and never
+        # replaces the client that in-flight requests are using
         try:
-            mongo_client = AsyncIOMotorClient(getenv("MONGODB_URI"))
-            mongo_db = mongo_client[getenv("MONGODB_DATABASE")]
-            config_collection = mongo_db[getenv("CONFIG_COLLECTION")]
-            conversation_collection = mongo_db[getenv("CONVERSATION_COLLECTION")]
-        except ConnectionFailure as e:
-            raise
+            _mongo_ok = await is_mongo_alive(mongo_client)
+            if not _mongo_ok:
+                logger.warning("MongoDB ping failed")
+        except Exception as e:
+            _mongo_ok = False
+            logger.exception(str(e))
+
+
+def mark_mongo_unhealthy():
+    global _mongo_ok
+
+    # the keepalive task re-pings right away and clears the flag once mongo answers
+    _mongo_ok = False
+    _mongo_recheck.set()
+
+
+def check_mongo_ok():
+    if not _mongo_ok:
+        raise HTTPException(status_code=503, detail="Database unavailable")
+
+
+@app.on_event("startup")
+async def startup():
+    global _mongo_keepalive_task
+
+    connect_mongo_db()
+    # may download BPE files, keep it off the event loop
+    await asyncio.to_thread(load_encodings)
+    # covers the distinct on client_id and the projected per client listing
+    await config_collection.create_index([("client_id", 1), ("config_id", 1), ("bot_name", 1)])
+    await conversation_collection.create_index("chat_id")
+    await archive_collection.create_index("chat_id")
+    _mongo_keepalive_task = asyncio.create_task(_mongo_keepalive())
+    get_openapi_bytes()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if _mongo_keepalive_task is not None:
+        _mongo_keepalive_task.cancel()
+    if mongo_client is not None:
+        mongo_client.close()
+
+
+@app.exception_handler(ConnectionFailure)
+async def mongo_connection_failure_handler(request: Request, exc: ConnectionFailure):
+    logger.exception(str(exc))
+    mark_mongo_unhealthy()
+    return ORJSONResponse({"error": "Database unavailable."}, status_code=503)
+
+
+async def _fetch_client_config(client_id: str, config_id: str) -> Optional[ClientAgentConfig]:
+    result = await config_collection.find_one({"client_id": client_id, "config_id": config_id})
+    if not result:
+        return None
+    return ClientAgentConfig.model_validate(result)
+
+
+def _on_client_config_fetched(key: Tuple[str, str], task: asyncio.Task):
+    # a config invalidated while its fetch was in flight must not be cached
+    if _config_inflight.get(key) is not task:
+        return
+    del _config_inflight[key]
+    if task.cancelled() or task.exception() is not None or task.result() is None:
+        return
+    _config_cache.pop(key, None)
+    if len(_config_cache) >= CONFIG_CACHE_MAX_SIZE:
+        # evict the oldest entry
+        _config_cache.pop(next(iter(_config_cache)))
+    _config_cache[key] = (time.monotonic() + CONFIG_CACHE_TTL, task.result())
+
+
+async def load_client_config(client_id: str, config_id: str) -> Optional[ClientAgentConfig]:
+    key = (client_id, config_id)
+    cached = _config_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    # concurrent cache misses for the same key share a single db call
+    task = _config_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_fetch_client_config(client_id, config_id))
+        _config_inflight[key] = task
+        task.add_done_callback(lambda done: _on_client_config_fetched(key, done))
+    return await asyncio.shield(task)
+
+
+def invalidate_client_config(client_id: str, config_id: str):
+    _config_cache.pop((client_id, config_id), None)
+    _config_inflight.pop((client_id, config_id), None)
 
 
 chat_router = APIRouter()
@@ -160,7 +305,7 @@ async def login(user: User) -> Dict:
         # Generate a JWT token for the user.
         token = create_jwt_token({"sub": user.username})
         # return for API Call
-        return JSONResponse({"access_token": token, "token_type": "bearer"})
+        return {"access_token": token, "token_type": "bearer"}
     else:
         # raise exception if user or pass not valid
         raise HTTPException(status_code=401, detail="Invalid credentials")
@@ -171,12 +316,27 @@ async def login(user: User) -> Dict:
 async def validate_token(
         current_user: str = Depends(get_current_user),
 ) -> Dict:
-    return JSONResponse({"detail": "Token Valid", "username": current_user})
+    return {"detail": "Token Valid", "username": current_user}
+
+
+_openapi_bytes: Optional[bytes] = None
+_openapi_schema: Optional[dict] = None
 
 
-@chat_router.get(f"/openapi.json", response_model=OpenAPI, include_in_schema=False)
+def get_openapi_bytes() -> bytes:
+    global _openapi_bytes
+    global _openapi_schema
+
+    # app.openapi() memoizes the schema, only serialize again if it was reset
+    if _openapi_bytes is None or app.openapi_schema is not _openapi_schema:
+        _openapi_schema = app.openapi()
+        _openapi_bytes = orjson.dumps(_openapi_schema)
+    return _openapi_bytes
+
+
+@chat_router.get(f"/openapi.json", include_in_schema=False)
 async def openapi(request: Request):
-    return JSONResponse(app.openapi())
+    return Response(content=get_openapi_bytes(), media_type="application/json")
 
 
 # API for accessing OpenAPI Docs
@@ -187,6 +347,15 @@ def swagger(request: Request):
     return get_swagger_ui_html(
         openapi_url=f"{API_BASE_PATH}/openapi.json",
         title="ChatBot",
+        swagger_ui_parameters=app.swagger_ui_parameters,
+    )
+
+
+@chat_router.get("/redoc", include_in_schema=False)
+def redoc(request: Request):
+    return get_redoc_html(
+        openapi_url=f"{API_BASE_PATH}/openapi.json",
+        title="ChatBot",
     )
 
 
@@ -196,15 +365,15 @@ async def insert_client_config(
     current_user: str = Depends(get_current_user)
 ):
     global config_collection
+    check_mongo_ok()
+    agent_config = config.agent_config.model_dump()
     try:
-        # update db to make sure it is active
-        await update_mongo_db()
-
         result = await config_collection.update_one(
             {"client_id": config.client_id, "config_id": config.config_id},
-            {"$set": {"agent_config": config.agent_config.model_dump(), "bot_name": config.bot_name ,"created_at": datetime.now(UTC)}},
+            {"$set": {"agent_config": agent_config, "bot_name": config.bot_name ,"created_at": datetime.now(UTC)}},
             upsert=True,
         )
+        invalidate_client_config(config.client_id, config.config_id)
 
         if result.modified_count == 0:
             return {
@@ -228,13 +397,11 @@ async def get_client_config(
     current_user: str = Depends(get_current_user)
 ):
     global config_collection
+    check_mongo_ok()
     try:
-        # update db to make sure it is active
-        await update_mongo_db()
-        result = await config_collection.find_one({"client_id": config.client_id, "config_id": config.config_id})
-        if not result:
-            return JSONResponse({"error": "No such bot config found."}, status_code=400)
-        agent_config = ClientAgentConfig.model_validate(result)
+        agent_config = await load_client_config(config.client_id, config.config_id)
+        if not agent_config:
+            return ORJSONResponse({"error": "No such bot config found."}, status_code=400)
         return agent_config
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -243,14 +410,12 @@ async def get_client_config(
 @chat_router.get("/client/list")
 async def get_client_config(current_user: str = Depends(get_current_user)):
     global config_collection
+    check_mongo_ok()
     try:
-        # update db to make sure it is active
-        await update_mongo_db()
         unique_clients = await config_collection.distinct("client_id")
-        print(unique_clients)
         if not unique_clients:
-            return JSONResponse({"error": f"No clients found."}, status_code=400)
-        return JSONResponse(unique_clients)
+            return ORJSONResponse({"error": f"No clients found."}, status_code=400)
+        return unique_clients
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -261,70 +426,209 @@ async def get_client_config(
     current_user: str = Depends(get_current_user)
 ):
     global config_collection
+    check_mongo_ok()
     try:
-        # update db to make sure it is active
-        await update_mongo_db()
         cursor = config_collection.find(
             {"client_id": client_id},
             {"client_id": 1, "config_id": 1, "bot_name": 1, "_id": 0}
         )
         results = await cursor.to_list(length=None)
         if not results:
-            return JSONResponse({"error": f"No agents found for client {client_id}"}, status_code=400)
-        return JSONResponse(results)
+            return ORJSONResponse({"error": f"No agents found for client {client_id}"}, status_code=400)
+        return results
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
+def encode_stream_frame(text: str) -> bytes:
+    return orjson.dumps({"t": text})
+
+
+# marks the end of one bot message, sent even when the reply is empty
+END_OF_TURN_FRAME = orjson.dumps({"done": True})
+
+
+async def _produce_tokens(tokens: AsyncGenerator[str, None], queue: asyncio.Queue):
+    try:
+        async for token in tokens:
+            # blocks while the queue is full, pausing the model stream
+            await queue.put(token)
+    except Exception:
+        await queue.put(None)
+        raise
+    await queue.put(None)
+
+
+async def send_response_stream(websocket: WebSocket, tokens: AsyncGenerator[str, None]):
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    producer = asyncio.create_task(_produce_tokens(tokens, queue))
+    try:
+        finished = False
+        while not finished:
+            token = await queue.get()
+            if token is None:
+                finished = True
+                break
+            # coalesce tokens into one frame for up to STREAM_FLUSH_INTERVAL
+            # seconds or STREAM_FLUSH_CHARS characters, a backlog is drained without waiting
+            buffer = [token]
+            size = len(token)
+            deadline = loop.time() + STREAM_FLUSH_INTERVAL
+            while size < STREAM_FLUSH_CHARS:
+                if queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        token = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    token = queue.get_nowait()
+                if token is None:
+                    finished = True
+                    break
+                buffer.append(token)
+                size += len(token)
+            # stop pulling from the model once the client has gone away
+            if (
+                websocket.application_state != WebSocketState.CONNECTED
+                or websocket.client_state != WebSocketState.CONNECTED
+            ):
+                break
+            await websocket.send_bytes(encode_stream_frame("".join(buffer)))
+        if finished:
+            # surfaces errors raised by the model stream
+            await producer
+            if websocket.client_state == WebSocketState.CONNECTED:
+                await websocket.send_bytes(END_OF_TURN_FRAME)
+    finally:
+        if not producer.done():
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+        await tokens.aclose()
+
+
+async def archive_chat_messages(
+    chat_id: str,
+    client_agent_config: ClientAgentConfig,
+    messages: List[Message],
+):
+    await archive_collection.insert_one(
+        {
+            "chat_id": chat_id,
+            "client_id": client_agent_config.client_id,
+            "config_id": client_agent_config.config_id,
+            "messages": [message.model_dump() for message in messages],
+            "archived_at": datetime.now(UTC),
+        }
+    )
+
+
+async def save_chat_messages(
+    chat_id: str,
+    client_agent_config: ClientAgentConfig,
+    messages: List[Message],
+    saved_count: int,
+) -> int:
+    # append only the unsaved messages, so each turn is an O(1) write
+    # instead of rewriting the whole conversation document
+    new_messages = messages[saved_count:]
+    if new_messages:
+        # the stored array mirrors the last messages of messages[:saved_count],
+        # whatever $slice is about to drop is archived from memory first so a
+        # failed archive write never loses messages
+        stored_count = min(saved_count, MAX_STORED_MESSAGES)
+        evicted_count = stored_count + len(new_messages) - MAX_STORED_MESSAGES
+        if evicted_count > 0:
+            first_stored = saved_count - stored_count
+            evicted = messages[first_stored:first_stored + evicted_count]
+            await archive_chat_messages(chat_id, client_agent_config, evicted)
+        await conversation_collection.update_one(
+            {"chat_id": chat_id},
+            {
+                "$push": {
+                    "messages": {
+                        "$each": [message.model_dump() for message in new_messages],
+                        "$slice": -MAX_STORED_MESSAGES,
+                    }
+                },
+                "$setOnInsert": {
+                    "client_id": client_agent_config.client_id,
+                    "config_id": client_agent_config.config_id,
+                    "bot_name": client_agent_config.bot_name,
+                    "timestamp": datetime.now(UTC),
+                },
+            },
+            upsert=True,
+        )
+    return len(messages)
+
+
 async def start_chat(websocket: WebSocket, client_id: str, config_id: str, chat_id: str):
     global config_collection
     global conversation_collection
     try:
         await websocket.accept()
-        await update_mongo_db()
         chat_agent = None
-        result = await config_collection.find_one({"client_id": client_id, "config_id": config_id})
-        if not result:
+        if not _mongo_ok:
+            await websocket.close(code=1011, reason="Database unavailable")
+            return
+        client_agent_config = await load_client_config(client_id, config_id)
+        if not client_agent_config:
             await websocket.close(reason="No such bot config found")
             return
-        client_agent_config = ClientAgentConfig.model_validate(result)
         agent_config = client_agent_config.agent_config
-        chat_history = await conversation_collection.find_one({"client_id": client_id, "config_id": config_id, "chat_id": chat_id})
-        if chat_history:
-            chat_history = ConversationHistory.model_validate(chat_history)
-            chat_agent = ChatGptAgent(agent_config=agent_config, messages=chat_history.messages)
+        # only the message fields are needed to replay a conversation, the
+        # timestamps are kept so evicted messages are archived unchanged
+        chat_history = await conversation_collection.find_one(
+            {"client_id": client_id, "config_id": config_id, "chat_id": chat_id},
+            {"messages.sender": 1, "messages.text": 1, "messages.timestamp": 1, "_id": 0},
+        )
+        if chat_history is not None:
+            chat_agent = ChatGptAgent(agent_config=agent_config, messages=chat_history.get("messages", []))
         else:
             chat_agent = ChatGptAgent(agent_config=agent_config)
-        if not chat_history:
+        # number of chat_agent.messages already persisted
+        saved_count = len(chat_agent.messages)
+        if chat_history is None:
             if agent_config.user_initial_message:
-                user_initial_message = Message(text=agent_config.user_initial_message)
-                bot_response = await chat_agent.generate_response(user_initial_message)
-                await websocket.send_text(bot_response)
+                user_initial_message = Message.model_construct(sender="user", text=agent_config.user_initial_message)
+                await send_response_stream(websocket, chat_agent.stream_response(user_initial_message))
 
             if agent_config.bot_initial_message:
-                bot_initial_message = Message(sender="bot", text=agent_config.bot_initial_message)
-                await chat_agent.generate_response(bot_initial_message)
-                await websocket.send_text(agent_config.bot_initial_message)
+                bot_initial_message = Message.model_construct(sender="bot", text=agent_config.bot_initial_message)
+                chat_agent.record_message(bot_initial_message)
+                await websocket.send_bytes(encode_stream_frame(agent_config.bot_initial_message))
+                await websocket.send_bytes(END_OF_TURN_FRAME)
+
+            saved_count = await save_chat_messages(chat_id, client_agent_config, chat_agent.messages, saved_count)
 
         while True:
             message = await websocket.receive_text()
             if message:
-                user_message = Message(text=message)
-                bot_response = await chat_agent.generate_response(user_message)
-                await websocket.send_text(bot_response)
+                user_message = Message.model_construct(sender="user", text=message)
+                await send_response_stream(websocket, chat_agent.stream_response(user_message))
+                saved_count = await save_chat_messages(chat_id, client_agent_config, chat_agent.messages, saved_count)
+    except ConnectionFailure as e:
+        logger.exception(str(e))
+        mark_mongo_unhealthy()
+        await websocket.close(code=1011, reason="Database unavailable")
     except WebSocketDisconnect:
-        conversation_history = ConversationHistory(
-            client_id=client_id,
-            config_id=config_id,
-            chat_id=chat_id,
-            bot_name=client_agent_config.bot_name,
-            messages=chat_agent.messages
-        )
-        result = await conversation_collection.update_one(
-            {"chat_id": conversation_history.chat_id},
-            {"$set": conversation_history.model_dump()},
-            upsert=True,
-        )
+        # persist anything recorded after the last completed turn,
+        # e.g. a partial reply cut off by the disconnect
+        if chat_agent is not None:
+            try:
+                await save_chat_messages(chat_id, client_agent_config, chat_agent.messages, saved_count)
+            except ConnectionFailure as e:
+                logger.exception(str(e))
+                mark_mongo_unhealthy()
+    except Exception as e:
+        # model errors end the session without persisting the unanswered turn
+        logger.exception(str(e))
+        if websocket.client_state == WebSocketState.CONNECTED:
+            await websocket.close(code=1011, reason="Failed to generate a response")
 
 
 chat_router.websocket("/chat/{client_id}/{config_id}/{chat_id}")(start_chat)
@@ -5,6 +5,8 @@ from pydantic import BaseModel, Field
 
 
 class Message(BaseModel):
+    # internal message plumbing builds these with model_construct, which
+    # skips validation but still fills in the defaults below
     sender: str = "user"
     text: str
     timestamp: datetime = Field(default_factory=lambda: datetime.now(UTC))
@@ -18,6 +20,8 @@ class FunctionFragment(BaseModel):
 class ChatGPTAgentConfig(BaseModel):
     prompt_preamble: str
     max_tokens: int = 400
+    # conversation history beyond this many tokens is summarized
+    max_tokens_context: int = 6000
     temperature: float = 0.3
     user_initial_message: Optional[str] = None
     bot_initial_message: Optional[str] = None
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+import backoff
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, AsyncStream, RateLimitError, InternalServerError, APIConnectionError, APITimeoutError
+
+from utils import getenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MAX_RPM = int(getenv("MAX_RPM", 500))
+MAX_TPM = int(getenv("MAX_TPM", 200000))
+MAX_CONCURRENT_REQUESTS = int(getenv("MAX_CONCURRENT_REQUESTS", 50))
+
+# rough estimate used for token throttling, OpenAI averages ~4 chars per token
+CHARS_PER_TOKEN = 4
+
+_semaphore: Optional[asyncio.Semaphore] = None
+_capacity: Optional[asyncio.Condition] = None
+_refill_task: Optional[asyncio.Task] = None
+requests_available: float = MAX_RPM
+tokens_available: float = MAX_TPM
+
+
+def estimate_tokens(chat_parameters: Dict[str, Any]) -> int:
+    prompt_chars = sum(len(message.get("content") or "") for message in chat_parameters.get("messages", []))
+    return prompt_chars // CHARS_PER_TOKEN + (chat_parameters.get("max_tokens") or 0)
+
+
+async def _refill_capacity():
+    global requests_available
+    global tokens_available
+
+    while True:
+        await asyncio.sleep(1)
+        requests_available = min(MAX_RPM, requests_available + MAX_RPM / 60)
+        tokens_available = min(MAX_TPM, tokens_available + MAX_TPM / 60)
+        async with _capacity:
+            _capacity.notify_all()
+
+
+def _ensure_started():
+    global _semaphore
+    global _capacity
+    global _refill_task
+
+    # created lazily so they are bound to the running event loop of the worker
+    if _refill_task is None or _refill_task.done():
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        _capacity = asyncio.Condition()
+        _refill_task = asyncio.create_task(_refill_capacity())
+
+
+async def _acquire_capacity(tokens: int):
+    global requests_available
+    global tokens_available
+
+    # a single request larger than the whole bucket would otherwise wait forever
+    tokens = min(tokens, MAX_TPM)
+    async with _capacity:
+        await _capacity.wait_for(lambda: requests_available >= 1 and tokens_available >= tokens)
+        requests_available -= 1
+        tokens_available -= tokens
+
+
+@backoff.on_exception(
+    backoff.expo,
+    (RateLimitError, InternalServerError, APIConnectionError, APITimeoutError),
+    max_tries=5,
+)
+async def _create_completion(client: AsyncOpenAI, chat_parameters: Dict[str, Any]):
+    return await client.chat.completions.create(**chat_parameters)
+
+
+async def submit(client: AsyncOpenAI, chat_parameters: Dict[str, Any]):
+    """Submit a chat completion request, throttled to stay within the RPM/TPM quota."""
+    _ensure_started()
+    await _acquire_capacity(estimate_tokens(chat_parameters))
+    async with _semaphore:
+        return await _create_completion(client, chat_parameters)
+
+
+@asynccontextmanager
+async def open_stream(client: AsyncOpenAI, chat_parameters: Dict[str, Any]) -> AsyncIterator[AsyncStream]:
+    """Open a streamed chat completion, holding a concurrency slot until the stream is closed."""
+    _ensure_started()
+    await _acquire_capacity(estimate_tokens(chat_parameters))
+    async with _semaphore:
+        stream = await _create_completion(client, {**chat_parameters, "stream": True})
+        try:
+            yield stream
+        finally:
+            # returns the pooled connection even when the consumer stops early
+            await stream.close()
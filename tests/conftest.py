@@ -0,0 +1,14 @@
+import os
+
+# main asserts these at import time
+for key in [
+    "OPENAI_API_KEY",
+    "MONGODB_URI",
+    "MONGODB_DATABASE",
+    "CONFIG_COLLECTION",
+    "CONVERSATION_COLLECTION",
+    "JWT_FAKE_USER",
+    "JWT_FAKE_PASSWORD",
+    "JWT_SECRET_KEY",
+]:
+    os.environ.setdefault(key, "test")
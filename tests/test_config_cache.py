@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+import main
+from models.agent_config import ClientAgentConfig, ChatGPTAgentConfig
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(main, "_config_cache", {})
+    monkeypatch.setattr(main, "_config_inflight", {})
+
+
+class FakeFetch:
+    """Stands in for _fetch_client_config, each call blocks until released."""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self, client_id, config_id):
+        self.calls += 1
+        await self.release.wait()
+        return ClientAgentConfig(
+            client_id=client_id,
+            config_id=config_id,
+            agent_config=ChatGPTAgentConfig(prompt_preamble=f"version {self.calls}"),
+        )
+
+
+def test_concurrent_misses_share_one_fetch(monkeypatch):
+    async def run():
+        fetch = FakeFetch()
+        monkeypatch.setattr(main, "_fetch_client_config", fetch)
+        loads = [asyncio.create_task(main.load_client_config("client", "config")) for _ in range(5)]
+        await asyncio.sleep(0)
+        fetch.release.set()
+        results = await asyncio.gather(*loads)
+        assert fetch.calls == 1
+        assert all(result is results[0] for result in results)
+
+        # served from the cache afterwards
+        assert await main.load_client_config("client", "config") is results[0]
+        assert fetch.calls == 1
+
+    asyncio.run(run())
+
+
+def test_config_invalidated_in_flight_is_not_cached(monkeypatch):
+    async def run():
+        fetch = FakeFetch()
+        monkeypatch.setattr(main, "_fetch_client_config", fetch)
+        stale = asyncio.create_task(main.load_client_config("client", "config"))
+        await asyncio.sleep(0)
+        main.invalidate_client_config("client", "config")
+        fetch.release.set()
+        assert (await stale).agent_config.prompt_preamble == "version 1"
+        assert ("client", "config") not in main._config_cache
+
+        fresh = await main.load_client_config("client", "config")
+        assert fetch.calls == 2
+        assert fresh.agent_config.prompt_preamble == "version 2"
+
+    asyncio.run(run())
+
+
+def test_expired_entries_are_fetched_again(monkeypatch):
+    async def run():
+        fetch = FakeFetch()
+        fetch.release.set()
+        monkeypatch.setattr(main, "_fetch_client_config", fetch)
+        monkeypatch.setattr(main, "CONFIG_CACHE_TTL", -1)
+        await main.load_client_config("client", "config")
+        await main.load_client_config("client", "config")
+        assert fetch.calls == 2
+
+    asyncio.run(run())
+
+
+def test_missing_configs_are_not_cached(monkeypatch):
+    async def run():
+        calls = []
+
+        async def fetch(client_id, config_id):
+            calls.append((client_id, config_id))
+            return None
+
+        monkeypatch.setattr(main, "_fetch_client_config", fetch)
+        assert await main.load_client_config("client", "missing") is None
+        assert await main.load_client_config("client", "missing") is None
+        assert len(calls) == 2
+
+    asyncio.run(run())
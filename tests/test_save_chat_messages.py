@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+import main
+from models.agent_config import ClientAgentConfig, ChatGPTAgentConfig, Message
+
+CAP = 4
+
+
+class FakeConversationCollection:
+    """Applies $push with $each/$slice to a single in-memory document."""
+
+    def __init__(self, stored=None):
+        self.stored = list(stored or [])
+
+    async def update_one(self, filter, update, upsert=False):
+        push = update["$push"]["messages"]
+        self.stored = (self.stored + push["$each"])[push["$slice"]:]
+
+
+class FakeArchiveCollection:
+    def __init__(self):
+        self.batches = []
+
+    async def insert_one(self, document):
+        self.batches.append(document["messages"])
+
+
+@pytest.fixture
+def collections(monkeypatch):
+    conversation = FakeConversationCollection()
+    archive = FakeArchiveCollection()
+    monkeypatch.setattr(main, "conversation_collection", conversation)
+    monkeypatch.setattr(main, "archive_collection", archive)
+    monkeypatch.setattr(main, "MAX_STORED_MESSAGES", CAP)
+    return conversation, archive
+
+
+def client_agent_config():
+    return ClientAgentConfig(
+        client_id="client",
+        config_id="config",
+        agent_config=ChatGPTAgentConfig(prompt_preamble="preamble"),
+    )
+
+
+def messages(count):
+    return [Message(sender="user" if idx % 2 == 0 else "bot", text=f"m{idx}") for idx in range(count)]
+
+
+def texts(dumps):
+    return [message["text"] for message in dumps]
+
+
+def save(transcript, saved_count):
+    return asyncio.run(main.save_chat_messages("chat", client_agent_config(), transcript, saved_count))
+
+
+def test_nothing_is_archived_below_the_cap(collections):
+    conversation, archive = collections
+    transcript = messages(4)
+    conversation.stored = [message.model_dump() for message in transcript[:2]]
+
+    assert save(transcript, 2) == 4
+    assert archive.batches == []
+    assert texts(conversation.stored) == ["m0", "m1", "m2", "m3"]
+
+
+def test_resumed_chat_at_the_cap_archives_the_oldest_stored(collections):
+    conversation, archive = collections
+    # the resumed transcript is exactly the stored array
+    transcript = messages(6)
+    conversation.stored = [message.model_dump() for message in transcript[:CAP]]
+
+    assert save(transcript, CAP) == 6
+    assert [texts(batch) for batch in archive.batches] == [["m0", "m1"]]
+    assert texts(conversation.stored) == ["m2", "m3", "m4", "m5"]
+
+
+def test_long_live_session_archives_only_what_is_still_stored(collections):
+    conversation, archive = collections
+    # m0..m3 were archived by earlier turns, m4..m7 are stored
+    transcript = messages(10)
+    conversation.stored = [message.model_dump() for message in transcript[4:8]]
+
+    assert save(transcript, 8) == 10
+    assert [texts(batch) for batch in archive.batches] == [["m4", "m5"]]
+    assert texts(conversation.stored) == ["m6", "m7", "m8", "m9"]
+
+
+def test_every_message_ends_up_stored_or_archived_once(collections):
+    conversation, archive = collections
+    transcript = []
+    saved_count = 0
+    # one user message and one bot reply per turn
+    for turn in messages(14)[::2]:
+        transcript.append(turn)
+        transcript.append(Message(sender="bot", text=f"reply to {turn.text}"))
+        saved_count = save(transcript, saved_count)
+
+    archived = [text for batch in archive.batches for text in texts(batch)]
+    assert archived + texts(conversation.stored) == [message.text for message in transcript]
+    assert len(conversation.stored) == CAP
@@ -0,0 +1,80 @@
+import asyncio
+
+import orjson
+import pytest
+from starlette.websockets import WebSocketState
+
+from main import send_response_stream
+
+
+class FakeWebSocket:
+    def __init__(self, disconnect_after=None):
+        self.frames = []
+        self.done_frames = 0
+        self.application_state = WebSocketState.CONNECTED
+        self.client_state = WebSocketState.CONNECTED
+        self.disconnect_after = disconnect_after
+
+    async def send_bytes(self, data):
+        frame = orjson.loads(data)
+        if frame.get("done"):
+            self.done_frames += 1
+            return
+        self.frames.append(frame["t"])
+        if self.disconnect_after and len(self.frames) >= self.disconnect_after:
+            self.client_state = WebSocketState.DISCONNECTED
+
+
+async def tokens(count, delay=0.0, error_at=None, events=None):
+    try:
+        for idx in range(count):
+            if idx == error_at:
+                raise RuntimeError("model failed")
+            if delay:
+                await asyncio.sleep(delay)
+            yield f"tok{idx} "
+        if error_at == count:
+            raise RuntimeError("model failed")
+    finally:
+        if events is not None:
+            events.append("closed")
+
+
+def test_coalesces_tokens_into_frames():
+    websocket = FakeWebSocket()
+    asyncio.run(send_response_stream(websocket, tokens(50)))
+    assert "".join(websocket.frames) == "".join(f"tok{idx} " for idx in range(50))
+    assert len(websocket.frames) < 50
+    assert websocket.done_frames == 1
+
+
+def test_empty_reply_still_ends_the_turn():
+    websocket = FakeWebSocket()
+    asyncio.run(send_response_stream(websocket, tokens(0)))
+    assert websocket.frames == []
+    assert websocket.done_frames == 1
+
+
+def test_flushes_slow_tokens_individually():
+    websocket = FakeWebSocket()
+    asyncio.run(send_response_stream(websocket, tokens(5, delay=0.05)))
+    assert websocket.frames == [f"tok{idx} " for idx in range(5)]
+    assert websocket.done_frames == 1
+
+
+@pytest.mark.parametrize("error_at", [0, 1, 5])
+@pytest.mark.parametrize("delay", [0.0, 0.05])
+def test_propagates_model_errors(error_at, delay):
+    websocket = FakeWebSocket()
+    with pytest.raises(RuntimeError, match="model failed"):
+        asyncio.run(send_response_stream(websocket, tokens(5, delay=delay, error_at=error_at)))
+    assert websocket.done_frames == 0
+
+
+def test_stops_model_stream_when_client_disconnects():
+    websocket = FakeWebSocket(disconnect_after=2)
+    events = []
+    asyncio.run(send_response_stream(websocket, tokens(1000, delay=0.001, events=events)))
+    assert len(websocket.frames) == 2
+    assert websocket.done_frames == 0
+    assert events == ["closed"]
@@ -0,0 +1,26 @@
+import pytest
+
+import utils
+
+
+@pytest.fixture(autouse=True)
+def empty_environment(monkeypatch):
+    monkeypatch.setattr(utils, "environment", {})
+
+
+@pytest.mark.parametrize("value", ["", "0", 0, False])
+def test_getenv_returns_falsy_values_set_via_setenv(monkeypatch, value):
+    monkeypatch.setenv("CHATBOT_TEST_KEY", "from os")
+    utils.setenv(CHATBOT_TEST_KEY=value)
+    assert utils.getenv("CHATBOT_TEST_KEY", "default") == value
+
+
+def test_getenv_falls_back_to_os_environ(monkeypatch):
+    monkeypatch.setenv("CHATBOT_TEST_KEY", "0")
+    assert utils.getenv("CHATBOT_TEST_KEY", "default") == "0"
+
+
+def test_getenv_returns_default_when_unset(monkeypatch):
+    monkeypatch.delenv("CHATBOT_TEST_KEY", raising=False)
+    assert utils.getenv("CHATBOT_TEST_KEY", "default") == "default"
+    assert utils.getenv("CHATBOT_TEST_KEY") is None
@@ -5,6 +5,7 @@ from typing import Optional, Union, AsyncGenerator, AsyncIterable, Literal, List
 from models.agent_config import FunctionFragment
 
 environment = {}
+_SENTINEL = object()
 
 
 def setenv(**kwargs):
@@ -13,7 +14,9 @@ def setenv(**kwargs):
 
 
 def getenv(key, default=None):
-    return environment.get(key) or os.getenv(key, default)
+    # values set through setenv win even when falsy, e.g. "" or "0"
+    value = environment.get(key, _SENTINEL)
+    return value if value is not _SENTINEL else os.environ.get(key, default)
 
 
 async def openai_get_tokens(gen, logger:Optional[Logger]=None) -> AsyncGenerator[Union[str, FunctionFragment], None]: